@@ -0,0 +1,62 @@
+import hashlib
+import os
+import pickle
+import time
+
+
+class FileCache:
+    """Small disk-backed cache for fetched series.
+
+    Entries are pickled alongside an expiry timestamp, keyed by the MD5 of
+    a caller-supplied string. Unlike st.cache_data this survives process
+    restarts, so cold Streamlit Cloud starts skip the network entirely
+    while the data is still within its TTL.
+    """
+
+    def __init__(self, directory='.cache'):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + '.pkl')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as fh:
+                expires_at, value = pickle.load(fh)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if time.time() > expires_at:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return value
+
+    def set(self, key, value, ttl):
+        with open(self._path(key), 'wb') as fh:
+            pickle.dump((time.time() + ttl, value), fh)
+
+    def prune(self):
+        """Delete expired or unreadable entries.
+
+        get() only evicts the key it was asked for, so entries whose key is
+        never requested again (e.g. keyed on a start date that has since
+        moved on) would otherwise accumulate indefinitely.
+        """
+        now = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path, 'rb') as fh:
+                    expires_at, _ = pickle.load(fh)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                expires_at = 0.0
+            if now > expires_at:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
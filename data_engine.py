@@ -0,0 +1,262 @@
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+
+from cache import FileCache
+
+_DAY = 86400
+
+# TTLs aligned to each source's publication cadence: weekly balance-sheet
+# series refetch weekly, monthly M2 series monthly, market prices daily.
+FRED_TTLS = {'WALCL': 7 * _DAY, 'ECBASSETSW': 7 * _DAY}
+FRED_DEFAULT_TTL = 30 * _DAY
+MARKET_TTL = _DAY
+
+# Kept under the temp dir so it lands on a writable volume on Streamlit Cloud
+_cache = FileCache(os.path.join(tempfile.gettempdir(), 'liquidity_cache'))
+# Sweep entries whose keys have rolled over (e.g. a new start month) once
+# per process start; get() alone never revisits them
+_cache.prune()
+
+
+def _shift(a, k):
+    # Shift a 1-D array by k slots with NaN padding, like Series.shift but
+    # as two plain memcpys instead of the pandas shift machinery
+    out = np.full_like(a, np.nan)
+    if k > 0:
+        out[k:] = a[:-k]
+    elif k < 0:
+        out[:k] = a[-k:]
+    else:
+        out[:] = a
+    return out
+
+
+def _to_monthly(series, master):
+    # Map observations onto the month-end master index by calendar month: a
+    # hash groupby taking the last observation per month, then a ffill over
+    # the monthly periods. Cheaper than reindex(method='ffill'), which does
+    # a per-target-point binary search and hits a slow path on tz mismatch.
+    monthly = series.groupby(series.index.to_period('M')).last()
+    return monthly.reindex(master.to_period('M')).ffill().to_numpy()
+
+
+def cached_fred(fred, code, start_str):
+    # Key on the start *month*, not the day-granular start date: the window
+    # anchor moves daily, and a day-granular key would miss every midnight
+    # rollover, making the 7d/30d TTLs unreachable. Within a month the
+    # fetched history is identical for chart purposes.
+    key = f"fred:{code}:{start_str[:7]}"
+    series = _cache.get(key)
+    if series is None:
+        series = fred.get_series(code, observation_start=start_str)
+        # Never persist an empty result: a transient FRED failure would
+        # otherwise poison every load for the whole TTL
+        if series is not None and not series.empty:
+            _cache.set(key, series, FRED_TTLS.get(code, FRED_DEFAULT_TTL))
+    return series
+
+
+def cached_yf(tickers, **kwargs):
+    # Deferred import: yfinance costs hundreds of ms at import time and is
+    # only needed on a disk-cache miss
+    key = f"yf:{tickers}:{sorted(kwargs.items())}"
+    data = _cache.get(key)
+    if data is None:
+        import yfinance as yf
+        data = yf.download(tickers, **kwargs)
+        # yf.download returns an empty frame on failure rather than
+        # raising; caching it would serve the outage for a full day
+        if data is not None and not data.empty:
+            _cache.set(key, data, MARKET_TTL)
+    return data
+
+
+# FRED series fetched per load; keys are the column names used downstream
+FRED_SERIES = {
+    'm2_us': 'M2SL',
+    'm2_eu': 'MANMM101EZM189S',
+    'm2_jp': 'MANMM101JPM189S',
+    'm2_cn': 'MANMM101CNM189S',
+    'cb_fed': 'WALCL',
+    'cb_ecb': 'ECBASSETSW',
+    'cb_boj': 'JPNASSETS',
+}
+
+# Column order of the pooled numeric block fed to the arithmetic
+NUMERIC_COLS = ['m2_us', 'm2_eu', 'm2_jp', 'm2_cn',
+                'fx_eu', 'fx_jp', 'fx_cn',
+                'cb_fed', 'cb_ecb', 'cb_boj']
+
+
+# Keep one Fred client per API key for the lifetime of the process so its
+# underlying requests.Session reuses pooled keep-alive connections instead
+# of paying a fresh TLS handshake on every rerun.
+@st.cache_resource(show_spinner=False)
+def get_fred(api_key):
+    from fredapi import Fred
+    return Fred(api_key=api_key)
+
+
+# Month-end index covering the maximum 15-year lookback, built once per day
+# instead of allocating and normalizing a fresh DatetimeIndex on every
+# cache miss; callers slice it down to their window.
+@st.cache_resource(ttl=86400, show_spinner=False)
+def get_master_index():
+    return pd.date_range(end=pd.Timestamp.now().normalize(), periods=15 * 12, freq='ME')
+
+
+# --- DATA ENGINE (WITH SHIFT PARAMETER) ---
+# NOTE: 'm2_shift_months' is part of the cache key alongside 'years'.
+# The cached layer stores Arrow IPC bytes rather than a pickled DataFrame:
+# columnar serialization is faster and more compact for this numeric-only
+# table, so cache hydrate on reruns is cheaper.
+@st.cache_data(ttl=43200, show_spinner=False)
+def _get_liquidity_ipc(_api_key, years, m2_shift_months, needs):
+    # The leading underscore keeps the API key out of the cache key: the
+    # data is identical for any valid key, so the key reduces to the two
+    # plain ints plus the frozenset of needed lines and no secret-derived
+    # hash is computed or stored.
+    df = _build_liquidity_frame(_api_key, years, m2_shift_months, needs)
+    if df is None:
+        return None
+    return pa.ipc.serialize_pandas(df).to_pybytes()
+
+
+def get_liquidity_data(api_key, years, m2_shift_months, needs):
+    buf = _get_liquidity_ipc(api_key, years, m2_shift_months, frozenset(needs))
+    if buf is None:
+        return None
+    return pa.ipc.deserialize_pandas(buf)
+
+
+def _build_liquidity_frame(api_key, years, m2_shift_months, needs):
+    fred = get_fred(api_key)
+
+    # Only fetch what the selected lines actually require
+    need_m2 = 'Global M2 ($T)' in needs
+    need_cb = 'CB Assets ($T)' in needs
+    need_mnav = 'MSTR MNAV (x)' in needs
+    need_btc = 'Bitcoin ($)' in needs or need_mnav
+    need_fx = need_m2 or need_cb
+
+    # Day-granularity anchor: a single normalized now() so every rerun the
+    # same day produces the same start_str — stable disk-cache keys and no
+    # second timestamp/relativedelta pass
+    today = pd.Timestamp.now().normalize()
+    start_date = today - pd.DateOffset(months=12 * years)
+    start_str = start_date.strftime('%Y-%m-%d')
+
+    # 1. SLICE THE MASTER MONTHLY INDEX (The Core Fix)
+    # This guarantees the DataFrame spans the entire period, even if data is missing.
+    full_index = get_master_index()
+    master_index = full_index[full_index >= start_date]
+    df = pd.DataFrame(index=master_index)
+
+    # 2. + 3. FETCH MARKET DATA (YFinance) AND MACRO DATA (FRED) IN PARALLEL
+    # All needed FRED series plus the yfinance batch are independent HTTP
+    # calls, so submit them to one thread pool and pay ~1 RTT instead of ~8.
+    tickers = []
+    if need_fx:
+        tickers += ["EURUSD=X", "JPY=X", "CNY=X"]
+    if need_btc:
+        tickers.append("BTC-USD")
+    if need_mnav:
+        tickers.append("MSTR")
+    series_ids = {k: sid for k, sid in FRED_SERIES.items()
+                  if (need_m2 if k.startswith('m2') else need_cb)}
+
+    try:
+        # One worker per FRED series plus the yfinance future
+        with ThreadPoolExecutor(max_workers=len(FRED_SERIES) + 1) as ex:
+            # Monthly bars directly: ~20x less payload than daily + resample
+            market_fut = ex.submit(cached_yf, tickers, start=start_str,
+                                   interval='1mo', progress=False,
+                                   threads=True, group_by='column') if tickers else None
+            futs = {k: ex.submit(cached_fred, fred, sid, start_str)
+                    for k, sid in series_ids.items()}
+            fetched = {k: f.result() for k, f in futs.items()}
+            market_data = market_fut.result()['Close'] if market_fut else None
+    except Exception as e:
+        st.warning(f"Error fetching data from FRED. Check logs or key.")
+        return None
+
+    # Align everything to the Master Index in one pass: concatenate the raw
+    # FRED series (monthly M2, weekly CB assets) and monthly FX rates on
+    # their native indexes, collapse to month-end bins, then do a single
+    # fill + reindex onto the master index. The resample takes the last
+    # observation per month per column, so the fill only runs over the
+    # monthly-sized frame rather than the daily/weekly union index.
+    if need_fx:
+        fetched['fx_eu'] = market_data['EURUSD=X']
+        fetched['fx_jp'] = market_data['JPY=X']
+        fetched['fx_cn'] = market_data['CNY=X']
+    if fetched:
+        raw = pd.concat(fetched, axis=1, sort=False).sort_index()
+        if raw.index.tz is not None:
+            # Keep both indexes tz-naive so reindex stays on the fast path
+            raw.index = raw.index.tz_localize(None)
+        raw = raw.resample('ME').last().ffill().reindex(df.index, method='ffill')
+    else:
+        raw = pd.DataFrame(index=df.index)
+
+    # 4. CALCULATE TOTALS (USD TRILLIONS)
+    # Pull the aligned columns out as one float32 ndarray and run the whole
+    # unit-conversion arithmetic as vectorized NumPy expressions, instead of
+    # ~12 per-column pandas ops each re-checking index alignment.
+    # Column-major layout: every op below is per-column, so F-order keeps
+    # each unpacked column contiguous in memory. float32 is plenty for
+    # values displayed at <7 significant digits, halves memory bandwidth,
+    # and shrinks the pickled st.cache_data entry.
+    A = np.asfortranarray(raw.reindex(columns=NUMERIC_COLS).to_numpy(dtype=np.float32))
+    m2_us, m2_eu, m2_jp, m2_cn, fx_eu, fx_jp, fx_cn, cb_fed, cb_ecb, cb_boj = A.T
+
+    # --- GLOBAL M2 CALCULATION (WHITE LINE) ---
+    # US M2SL is in Billions -> / 1000 (to Trillions)
+    # Non-US M2 (Millions of Local Currency) -> Convert to USD, then / 1,000,000 (to Trillions)
+    if need_m2:
+        global_m2 = (np.nan_to_num(m2_us / 1000)
+                     + np.nan_to_num((m2_eu * fx_eu) / 1_000_000)
+                     + np.nan_to_num((m2_jp / fx_jp) / 1_000_000)
+                     + np.nan_to_num((m2_cn * fx_cn) / 1_000_000))
+
+        # --- APPLY THE M2 TIME SHIFT HERE! ---
+        df['Global_M2'] = _shift(global_m2, m2_shift_months)
+
+    # --- CB ASSETS CALCULATION (RED LINE) ---
+    # US WALCL is in Millions -> / 1,000,000 (to Trillions)
+    # ECB Assets are in Millions of Local Currency -> Convert to USD, then / 1,000,000 (to Trillions)
+    # BOJ JPNASSETS is in 100 Millions of Yen -> conversion to USD Trillions
+    if need_cb:
+        df['Global_Assets'] = (np.nan_to_num(cb_fed / 1_000_000)
+                               + np.nan_to_num((cb_ecb * fx_eu) / 1_000_000)
+                               + np.nan_to_num((cb_boj * 0.0001) / fx_jp))
+
+    # --- BITCOIN DATA (FIXED FOR CURRENT DATE) ---
+
+    # 1. Reuse BTC from the batched download instead of a second
+    # yf.download round-trip.
+    # 2. Align to the master monthly index, filling forward to the present.
+    # This forces the line to use the latest price up to the final date in the index.
+    if need_btc:
+        df['BTC'] = _to_monthly(market_data['BTC-USD'], df.index).astype(np.float32)
+
+    # --- MICROSTRATEGY MNAV CALCULATION (REUSING FETCHED DATA) ---
+    if need_mnav:
+        # MNAV = MSTR price / (BTC price * approximation divisor of 20),
+        # done as one vector expression straight from the batched download.
+        # The intermediate price/ratio columns were never plotted, and no
+        # trailing ffill is needed since both inputs are already filled.
+        mstr_arr = _to_monthly(market_data['MSTR'], df.index).astype(np.float32)
+        df['MSTR_MNAV'] = mstr_arr / (df['BTC'].to_numpy() * np.float32(20.0))
+
+    # FINAL CLEANUP: MSTR_MNAV should NOT be in the dropna subset
+    subset = [c for c in ('Global_M2', 'Global_Assets') if c in df.columns]
+    if subset:
+        df = df.dropna(subset=subset, how='all')
+    return df